@@ -0,0 +1,299 @@
+"""
+Offline conversion of the Spleeter 4-stems U-Nets to ONNX.
+
+Run once (at image build time) to dump one graph per stem; the runtime
+backend in onnx_separator.py then serves them through ONNX Runtime with
+the TensorRT/CUDA execution providers instead of the TF estimator API.
+
+Usage:
+    python export_onnx.py --output-dir /models/spleeter-4stems-onnx
+"""
+
+import argparse
+from pathlib import Path
+
+from onnx_separator import STEMS, N_FREQ_BINS, SAMPLE_RATE, SEGMENT_FRAMES
+
+def export_stems(output_dir: Path):
+    import tensorflow as tf
+    import tf2onnx
+    from spleeter.model.functions.unet import apply_unet
+    from spleeter.model.provider import ModelProvider
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    model_dir = ModelProvider.default().get("4stems")
+    checkpoint = tf.train.latest_checkpoint(model_dir)
+
+    # The checkpoint names variables by Keras auto-naming, which counts
+    # sequentially across all four U-Nets (the drums net starts at
+    # conv2d_7, not conv2d), so the nets must be built in one graph in
+    # config order - building each stem in a fresh graph would silently
+    # restore the vocals weights into every net. The 4stems config also
+    # trains with ELU activations, not apply_unet's LeakyReLU/ReLU
+    # defaults.
+    params = {"conv_activation": "ELU", "deconv_activation": "ELU"}
+
+    graph = tf.Graph()
+    with graph.as_default():
+        spectrogram = tf.compat.v1.placeholder(
+            tf.float32,
+            shape=(None, SEGMENT_FRAMES, N_FREQ_BINS, 2),
+            name="magnitude_spectrogram"
+        )
+        estimates = {
+            stem: apply_unet(
+                spectrogram,
+                output_name=f"{stem}_spectrogram",
+                params=params
+            )
+            for stem in STEMS
+        }
+
+        frozen = {}
+        with tf.compat.v1.Session(graph=graph) as session:
+            tf.compat.v1.train.Saver().restore(session, checkpoint)
+
+            # Freezing against one stem's output prunes the graph down to
+            # that stem's subgraph, so each exported file stays single-net
+            for stem, estimate in estimates.items():
+                frozen[stem] = tf.compat.v1.graph_util.convert_variables_to_constants(
+                    session,
+                    graph.as_graph_def(),
+                    [estimate.op.name]
+                )
+
+    for stem, graph_def in frozen.items():
+        model_proto, _ = tf2onnx.convert.from_graph_def(
+            graph_def,
+            input_names=["magnitude_spectrogram:0"],
+            output_names=[f"{estimates[stem].op.name}:0"],
+            opset=15
+        )
+
+        target = output_dir / f"{stem}.onnx"
+        target.write_bytes(model_proto.SerializeToString())
+        _smoke_test(target)
+        print(f"Exported {stem} U-Net -> {target}")
+
+def _smoke_test(model_path: Path):
+    """
+    Run a zeros segment through a freshly exported graph so a broken
+    export fails the image build instead of the first live request.
+    """
+    import numpy as np
+    import onnxruntime
+
+    session = onnxruntime.InferenceSession(
+        str(model_path), providers=["CPUExecutionProvider"]
+    )
+    segment = np.zeros((1, SEGMENT_FRAMES, N_FREQ_BINS, 2), dtype=np.float32)
+    output = session.run(None, {session.get_inputs()[0].name: segment})[0]
+
+    if output.shape != segment.shape:
+        raise RuntimeError(
+            f"Exported graph {model_path} returned shape {output.shape}, "
+            f"expected {segment.shape}"
+        )
+
+def fuse_drums_graph(output_dir: Path):
+    """
+    Stitch the four per-stem U-Nets into one graph that shares a single
+    magnitude-spectrogram input and emits only the drums ratio mask.
+
+    The separate per-stem graphs each re-read the same input and return
+    full magnitude estimates that the runtime then squares, sums and
+    divides in numpy. Fusing moves that arithmetic into the graph -
+    same FLOPs, one session.run, and ~75% less output bandwidth since
+    the vocals/bass/other estimates never leave the GPU.
+    """
+    import onnx
+    from onnx import compose, helper
+
+    models = {
+        stem: onnx.load(str(output_dir / f"{stem}.onnx")) for stem in STEMS
+    }
+
+    nodes = []
+    initializers = [
+        helper.make_tensor("epsilon", onnx.TensorProto.FLOAT, [], [1e-10])
+    ]
+    squared = {}
+
+    for stem, model in models.items():
+        # Prefix node/edge names so the four graphs can coexist, but keep
+        # the input name shared across all of them
+        prefixed = compose.add_prefix(
+            model, prefix=f"{stem}/", rename_inputs=False
+        )
+        nodes.extend(prefixed.graph.node)
+        initializers.extend(prefixed.graph.initializer)
+
+        estimate = prefixed.graph.output[0].name
+        squared[stem] = f"{stem}_squared"
+        nodes.append(
+            helper.make_node("Mul", [estimate, estimate], [squared[stem]])
+        )
+
+    # Wiener-style ratio mask for drums: drums^2 / (sum of squares + eps)
+    nodes.append(helper.make_node("Sum", list(squared.values()), ["stem_energy"]))
+    nodes.append(helper.make_node("Add", ["stem_energy", "epsilon"], ["total_energy"]))
+    nodes.append(helper.make_node("Div", [squared["drums"], "total_energy"], ["drums_mask"]))
+
+    graph = helper.make_graph(
+        nodes,
+        "spleeter_drums_fused",
+        inputs=list(models["drums"].graph.input),
+        outputs=[
+            helper.make_tensor_value_info(
+                "drums_mask",
+                onnx.TensorProto.FLOAT,
+                [None, SEGMENT_FRAMES, N_FREQ_BINS, 2]
+            )
+        ],
+        initializer=initializers
+    )
+
+    fused = helper.make_model(
+        graph, opset_imports=models["drums"].opset_import
+    )
+
+    target = output_dir / "drums_mask.onnx"
+    onnx.save(fused, str(target))
+    print(f"Fused drums-mask graph -> {target}")
+
+def quantize_stems(output_dir: Path, reference_clip: Path = None):
+    """
+    Produce FP16 and INT8 variants of each exported stem graph.
+
+    The T4's tensor cores run FP16 convs ~2x and INT8 ~4x faster than
+    FP32. FP16 is safe for the U-Net conv stacks; INT8 only ships when a
+    reference clip is supplied and the quantized masks stay faithful -
+    without one, no .int8.onnx is written and the runtime serves FP16.
+    """
+    import onnx
+    from onnxconverter_common import float16
+    from onnxruntime.quantization import quantize_dynamic
+
+    for stem in (*STEMS, "drums_mask"):
+        source = output_dir / f"{stem}.onnx"
+        if not source.exists():
+            continue
+
+        fp16_model = float16.convert_float_to_float16(onnx.load(str(source)))
+        fp16_target = output_dir / f"{stem}.fp16.onnx"
+        onnx.save(fp16_model, str(fp16_target))
+        print(f"Quantized {stem} -> {fp16_target}")
+
+        if reference_clip is None:
+            continue
+
+        int8_target = output_dir / f"{stem}.int8.onnx"
+        quantize_dynamic(str(source), str(int8_target))
+
+        if _int8_is_faithful(source, int8_target, reference_clip):
+            print(f"Quantized {stem} -> {int8_target}")
+        else:
+            int8_target.unlink()
+            print(f"INT8 {stem} regressed on reference clip - keeping FP16")
+
+def _int8_is_faithful(fp32_path, int8_path, reference_clip, tolerance=0.05):
+    """
+    Compare INT8 mask output against FP32 on a reference clip.
+    Returns False when the mean absolute deviation exceeds tolerance.
+    """
+    import numpy as np
+    import librosa
+    import onnxruntime
+
+    from onnx_separator import OnnxSeparator, SAMPLE_RATE
+
+    waveform, _ = librosa.load(str(reference_clip), sr=SAMPLE_RATE, mono=False)
+    if waveform.ndim == 1:
+        waveform = np.stack([waveform, waveform])
+    waveform = waveform.T.astype(np.float32)
+
+    magnitude = np.abs(
+        OnnxSeparator._stft(waveform)[:, :N_FREQ_BINS, :]
+    ).astype(np.float32)
+    segments = OnnxSeparator._segment(magnitude)
+
+    outputs = []
+    for path in (fp32_path, int8_path):
+        session = onnxruntime.InferenceSession(
+            str(path), providers=["CPUExecutionProvider"]
+        )
+        input_name = session.get_inputs()[0].name
+        outputs.append(session.run(None, {input_name: segments})[0])
+
+    deviation = np.mean(np.abs(outputs[0] - outputs[1]))
+    scale = np.mean(np.abs(outputs[0])) + 1e-10
+    return (deviation / scale) < tolerance
+
+def verify_against_tf(output_dir: Path, tolerance: float = 0.10):
+    """
+    A/B the ONNX backend against the TF separator on a seeded noise clip.
+
+    Writes the marker file the runtime requires before it will prefer
+    the ONNX path. A failure raises, failing the image build: the ONNX
+    backend (and the FP16/INT8 variants and fused drums-mask graph
+    behind it) is the whole point of the export, so shipping an image
+    that silently falls back to the TF Separator forever would just be
+    dead weight nobody notices. Runs after quantization so the check
+    covers whichever graph variant would actually be served.
+    """
+    import numpy as np
+    from spleeter.separator import Separator
+
+    from onnx_separator import OnnxSeparator, VERIFIED_MARKER
+
+    rng = np.random.default_rng(0)
+    clip = (rng.standard_normal((SAMPLE_RATE * 2, 2)) * 0.1).astype(np.float32)
+
+    reference = Separator(
+        'spleeter:4stems', multiprocess=False
+    ).separate(clip)['drums']
+    candidate = OnnxSeparator(
+        output_dir, providers=["CPUExecutionProvider"]
+    ).separate(clip)['drums']
+
+    length = min(len(reference), len(candidate))
+    error = np.linalg.norm(candidate[:length] - reference[:length]) / (
+        np.linalg.norm(reference[:length]) + 1e-10
+    )
+
+    if error >= tolerance:
+        raise RuntimeError(
+            f"ONNX backend failed A/B vs TF separator "
+            f"(relative L2 {error:.3f} >= {tolerance}) - failing the build "
+            f"rather than shipping graphs the runtime would never serve"
+        )
+
+    (output_dir / VERIFIED_MARKER).write_text(f"relative_l2={error:.4f}\n")
+    print(f"ONNX backend verified vs TF separator (relative L2 {error:.3f})")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export Spleeter 4-stems U-Nets to ONNX"
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=Path,
+        default=Path("/models/spleeter-4stems-onnx"),
+        help="Directory to write the per-stem .onnx graphs"
+    )
+    parser.add_argument(
+        "--reference-clip",
+        type=Path,
+        default=None,
+        help="Audio clip used to validate INT8 masks against FP32"
+    )
+    args = parser.parse_args()
+
+    export_stems(args.output_dir)
+    fuse_drums_graph(args.output_dir)
+    quantize_stems(args.output_dir, args.reference_clip)
+    verify_against_tf(args.output_dir)
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,31 @@ with real-time WebSocket progress streaming.
 """
 
 from fastapi import FastAPI, UploadFile, WebSocket, HTTPException, BackgroundTasks
+from fastapi import Path as PathParam
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from pydantic import BaseModel
 from pathlib import Path
-import uuid
+from secrets import token_hex
+import aiofiles
+import os
+import redis.asyncio as redis
 import asyncio
-import json
+import orjson
 from typing import Optional, AsyncGenerator
 from datetime import datetime, timedelta
 import shutil
 
-from pipeline import DrumPipeline, ProcessingStage
+from pipeline import DrumPipeline, ProcessingStage, warm_models
+
+# uvloop cuts asyncio scheduling overhead 2-4x, which directly lowers the
+# cost of the per-progress send_json loop. Install it before the event
+# loop exists; fall back silently where it's unavailable.
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 # Models
 class UploadResponse(BaseModel):
@@ -46,8 +59,11 @@ class TaskStatus(BaseModel):
 # Configuration
 UPLOAD_DIR = Path("/tmp/drumextract/uploads")
 OUTPUT_DIR = Path("/tmp/drumextract/outputs")
-ALLOWED_EXTENSIONS = {".wav", ".mp3", ".m4a", ".flac"}
+ALLOWED_EXTENSIONS = frozenset({".wav", ".mp3", ".m4a", ".flac"})
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Stream uploads in 1MB chunks
+PROGRESS_QUEUE_SIZE = 8  # Max progress updates buffered per WebSocket
+WS_SEND_TIMEOUT = 5  # Seconds before a slow client's update is dropped
 
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
@@ -69,30 +85,86 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Task Registry (In production, use Redis)
-task_registry = {}
+# Task Registry - Redis-backed so task state survives container restarts
+# and is shared across Modal replicas
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+
+RUNNING_TASKS_KEY = "running_tasks"        # set of task_ids currently processing
+FINISHED_TASKS_KEY = "finished_tasks"      # set of task_ids complete or failed
+TASKS_BY_CREATED_KEY = "tasks_by_created"  # zset scored by creation timestamp
+
+def _task_key(task_id: str) -> str:
+    """Redis hash key holding a task's metadata"""
+    return f"task:{task_id}"
+
+# Task ids are 16 random bytes as hex; reject anything else at the
+# routing layer so ids can't smuggle path separators or Redis patterns
+TASK_ID_PATTERN = r"^[0-9a-f]{32}$"
 
 # Pipeline Instance
 pipeline = DrumPipeline(output_dir=OUTPUT_DIR)
 
+async def ws_send(websocket: WebSocket, payload: dict):
+    """
+    Send a payload over the socket with orjson (5-10x faster than the
+    stdlib json path behind send_json on these small dicts). Text frames
+    keep the browser client's JSON.parse(event.data) working.
+    """
+    await websocket.send_text(orjson.dumps(payload).decode())
+
 # Cleanup Task
+def _sweep_orphans(cutoff: float):
+    """
+    Remove files past the cutoff that no task record covers (crashed
+    uploads, leftovers from before the Redis registry). os.scandir
+    serves each entry's stat from the readdir cache, so this is one
+    syscall per directory rather than one per file.
+    """
+    for directory in (UPLOAD_DIR, OUTPUT_DIR):
+        for entry in os.scandir(directory):
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    if entry.is_file(follow_symlinks=False):
+                        os.unlink(entry.path)
+                    else:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+            except FileNotFoundError:
+                pass  # Already removed by the task expiry pass
+
 async def cleanup_old_files():
-    """Remove files older than 1 hour"""
+    """Expire tasks (files + Redis records) older than 1 hour"""
     while True:
         await asyncio.sleep(300)  # Every 5 minutes
-        cutoff = datetime.now() - timedelta(hours=1)
-        
-        for directory in [UPLOAD_DIR, OUTPUT_DIR]:
-            for item in directory.iterdir():
-                if item.is_file():
-                    mtime = datetime.fromtimestamp(item.stat().st_mtime)
-                    if mtime < cutoff:
-                        item.unlink()
-                elif item.is_dir():
-                    try:
-                        shutil.rmtree(item)
-                    except Exception:
-                        pass
+        cutoff = (datetime.now() - timedelta(hours=1)).timestamp()
+
+        try:
+            # O(log N) range over the creation-time zset instead of statting
+            # every file in the upload/output directories
+            expired = await redis_client.zrangebyscore(
+                TASKS_BY_CREATED_KEY, "-inf", cutoff
+            )
+
+            for task_id in expired:
+                task = await redis_client.hgetall(_task_key(task_id))
+
+                for key in ("upload_path", "midi_path", "drum_path"):
+                    if key in task:
+                        # missing_ok: cancel_task may race us on the same file
+                        Path(task[key]).unlink(missing_ok=True)
+
+                await redis_client.delete(_task_key(task_id))
+                await redis_client.zrem(TASKS_BY_CREATED_KEY, task_id)
+                await redis_client.srem(RUNNING_TASKS_KEY, task_id)
+                await redis_client.srem(FINISHED_TASKS_KEY, task_id)
+
+            # Anything still on disk past the cutoff has no live task record
+            # (tracked files were just deleted above) - sweep it as an orphan
+            await asyncio.to_thread(_sweep_orphans, cutoff)
+        except Exception as e:
+            # A transient Redis or filesystem error must not kill the
+            # container's only cleanup loop; try again next tick
+            print(f"Cleanup pass failed: {e}")
 
 @app.on_event("startup")
 async def startup_event():
@@ -106,47 +178,60 @@ async def upload_audio(file: UploadFile):
     Upload audio file for processing.
     Returns task_id for WebSocket connection.
     """
-    # Validate file extension
-    file_ext = Path(file.filename).suffix.lower()
+    # Validate file extension - rpartition avoids building a Path object
+    # just to read its suffix
+    _, dot, ext = file.filename.rpartition('.')
+    file_ext = f".{ext.lower()}" if dot else ""
     if file_ext not in ALLOWED_EXTENSIONS:
         raise HTTPException(
             status_code=400,
             detail=f"Unsupported file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
         )
     
-    # Generate task ID
-    task_id = str(uuid.uuid4())
+    # Generate task ID - raw hex avoids the UUID parse/format overhead
+    # and keeps ids trivially validatable in path parameters
+    task_id = token_hex(16)
     
     # Save uploaded file
     upload_path = UPLOAD_DIR / f"{task_id}{file_ext}"
     
     try:
-        content = await file.read()
-        
-        # Validate file size
-        if len(content) > MAX_FILE_SIZE:
-            raise HTTPException(
-                status_code=400,
-                detail=f"File too large. Max size: {MAX_FILE_SIZE / (1024*1024)}MB"
-            )
-        
-        with open(upload_path, "wb") as f:
-            f.write(content)
-        
+        # Stream to disk in chunks - avoids holding the whole body in
+        # memory and lets oversized uploads abort before the tail arrives
+        total_bytes = 0
+        async with aiofiles.open(upload_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                total_bytes += len(chunk)
+                if total_bytes > MAX_FILE_SIZE:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"File too large. Max size: {MAX_FILE_SIZE / (1024*1024)}MB"
+                    )
+                await f.write(chunk)
+
         # Register task
-        task_registry[task_id] = {
+        created_at = datetime.now()
+        await redis_client.hset(_task_key(task_id), mapping={
             "status": "pending",
             "upload_path": str(upload_path),
             "filename": file.filename,
-            "created_at": datetime.now()
-        }
-        
+            "created_at": created_at.isoformat()
+        })
+        await redis_client.zadd(
+            TASKS_BY_CREATED_KEY, {task_id: created_at.timestamp()}
+        )
+
         return UploadResponse(
             task_id=task_id,
             status="success",
             message=f"File uploaded successfully. Connect to /ws/process/{task_id}"
         )
     
+    except HTTPException:
+        if upload_path.exists():
+            upload_path.unlink()
+        raise
+
     except Exception as e:
         if upload_path.exists():
             upload_path.unlink()
@@ -161,51 +246,107 @@ async def process_audio(websocket: WebSocket, task_id: str):
     await websocket.accept()
     
     # Validate task
-    if task_id not in task_registry:
-        await websocket.send_json({
+    task = await redis_client.hgetall(_task_key(task_id))
+
+    if not task:
+        await ws_send(websocket, {
             "error": "Invalid task ID",
             "task_id": task_id
         })
         await websocket.close()
         return
-    
-    task = task_registry[task_id]
-    
+
     if task["status"] == "processing":
-        await websocket.send_json({
+        await ws_send(websocket, {
             "error": "Task already processing",
             "task_id": task_id
         })
         await websocket.close()
         return
-    
+
     # Update status
-    task["status"] = "processing"
+    await redis_client.hset(_task_key(task_id), "status", "processing")
+    await redis_client.sadd(RUNNING_TASKS_KEY, task_id)
     upload_path = task["upload_path"]
-    
+
+    producer = None
+
     try:
-        # Process through pipeline with progress streaming
-        async for progress in pipeline.process(task_id, upload_path):
-            # Send progress update
-            update = ProgressUpdate(
-                task_id=task_id,
-                stage=progress["stage"],
-                percent=progress["percent"],
-                message=progress["message"],
-                timestamp=datetime.now().isoformat()
-            )
-            
-            await websocket.send_json(update.dict())
-            
+        # Bounded queue between the pipeline producer and the socket
+        # writer: a slow client can't grow the transmit buffer without
+        # limit or stall inference behind its reads
+        progress_queue: asyncio.Queue = asyncio.Queue(maxsize=PROGRESS_QUEUE_SIZE)
+
+        async def produce_progress():
+            try:
+                async for progress in pipeline.process(task_id, upload_path):
+                    # Plain dict on the hot path - ProgressUpdate model
+                    # construction/re-walking is reserved for the REST
+                    # /status response where FastAPI serializes anyway
+                    update = {
+                        "task_id": task_id,
+                        "stage": progress["stage"],
+                        "percent": progress["percent"],
+                        "message": progress["message"],
+                        "timestamp": datetime.now().isoformat()
+                    }
+
+                    if progress_queue.full():
+                        # Coalesce: drop queued updates for the same stage
+                        # so only the freshest progress waits on the wire
+                        backlog = []
+                        while not progress_queue.empty():
+                            item = progress_queue.get_nowait()
+                            if item["stage"] != update["stage"]:
+                                backlog.append(item)
+                        for item in backlog:
+                            progress_queue.put_nowait(item)
+
+                    await progress_queue.put(update)
+            except asyncio.CancelledError:
+                # Writer is being torn down (client gone) - nothing will
+                # read a sentinel, and putting one could block forever
+                raise
+            except Exception:
+                await progress_queue.put(None)
+                raise
+            else:
+                await progress_queue.put(None)  # End-of-stream marker
+
+        producer = asyncio.create_task(produce_progress())
+
+        while (update := await progress_queue.get()) is not None:
             # Store latest progress
-            task["progress"] = update.dict()
-        
-        # Processing complete
-        task["status"] = "complete"
-        task["midi_path"] = str(OUTPUT_DIR / f"{task_id}_drums.mid")
-        task["drum_path"] = str(OUTPUT_DIR / f"{task_id}_drums.wav")
-        
-        await websocket.send_json({
+            await redis_client.hset(
+                _task_key(task_id), "progress", orjson.dumps(update)
+            )
+
+            try:
+                await asyncio.wait_for(
+                    ws_send(websocket, update),
+                    timeout=WS_SEND_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                # Client isn't reading; skip this update rather than
+                # backing up the whole pipeline behind it
+                continue
+
+        # Surface any pipeline error from the producer
+        await producer
+
+        # Processing complete - build the output paths once; every later
+        # status/download lookup reads these cached strings from Redis
+        midi_path = str(OUTPUT_DIR / f"{task_id}_drums.mid")
+        drum_path = str(OUTPUT_DIR / f"{task_id}_drums.wav")
+
+        await redis_client.hset(_task_key(task_id), mapping={
+            "status": "complete",
+            "midi_path": midi_path,
+            "drum_path": drum_path
+        })
+        await redis_client.smove(RUNNING_TASKS_KEY, FINISHED_TASKS_KEY, task_id)
+
+        await ws_send(websocket, {
             "complete": True,
             "task_id": task_id,
             "midi_url": f"/download/midi/{task_id}",
@@ -214,10 +355,13 @@ async def process_audio(websocket: WebSocket, task_id: str):
         })
     
     except Exception as e:
-        task["status"] = "failed"
-        task["error"] = str(e)
-        
-        await websocket.send_json({
+        await redis_client.hset(_task_key(task_id), mapping={
+            "status": "failed",
+            "error": str(e)
+        })
+        await redis_client.smove(RUNNING_TASKS_KEY, FINISHED_TASKS_KEY, task_id)
+
+        await ws_send(websocket, {
             "error": "Processing failed",
             "details": str(e),
             "task_id": task_id,
@@ -225,97 +369,133 @@ async def process_audio(websocket: WebSocket, task_id: str):
         })
     
     finally:
+        # A failed send (closed tab) exits the writer loop without
+        # stopping the producer, which would then block forever on the
+        # bounded queue with the pipeline stuck mid-yield - cancel it so
+        # the generator unwinds and releases its resources
+        if producer is not None and not producer.done():
+            producer.cancel()
+            try:
+                await producer
+            except (asyncio.CancelledError, Exception):
+                pass
+
         await websocket.close()
 
 @app.get("/status/{task_id}", response_model=TaskStatus)
-async def get_status(task_id: str):
+async def get_status(task_id: str = PathParam(pattern=TASK_ID_PATTERN)):
     """
     Check processing status without WebSocket.
     Useful for reconnection or polling.
     """
-    if task_id not in task_registry:
+    task = await redis_client.hgetall(_task_key(task_id))
+
+    if not task:
         raise HTTPException(status_code=404, detail="Task not found")
-    
-    task = task_registry[task_id]
-    
+
+    progress = orjson.loads(task["progress"]) if "progress" in task else None
+
     return TaskStatus(
         task_id=task_id,
         status=task["status"],
-        progress=task.get("progress"),
+        progress=progress,
         midi_url=f"/download/midi/{task_id}" if task["status"] == "complete" else None,
         drum_url=f"/download/drum/{task_id}" if task["status"] == "complete" else None,
         error=task.get("error")
     )
 
 @app.get("/download/midi/{task_id}")
-async def download_midi(task_id: str):
+async def download_midi(task_id: str = PathParam(pattern=TASK_ID_PATTERN)):
     """Download generated MIDI file"""
-    if task_id not in task_registry:
+    task = await redis_client.hgetall(_task_key(task_id))
+
+    if not task:
         raise HTTPException(status_code=404, detail="Task not found")
-    
-    task = task_registry[task_id]
-    
+
     if task["status"] != "complete":
         raise HTTPException(status_code=400, detail="Processing not complete")
     
     midi_path = Path(task["midi_path"])
-    
-    if not midi_path.exists():
+
+    # Single stat doubles as the existence check; passing it to
+    # FileResponse skips Starlette's own stat before the sendfile path
+    try:
+        stat_result = midi_path.stat()
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="MIDI file not found")
-    
+
     return FileResponse(
         path=midi_path,
         media_type="audio/midi",
-        filename=f"{task['filename']}_drums.mid"
+        filename=f"{task['filename']}_drums.mid",
+        stat_result=stat_result
     )
 
 @app.get("/download/drum/{task_id}")
-async def download_drum_audio(task_id: str):
+async def download_drum_audio(task_id: str = PathParam(pattern=TASK_ID_PATTERN)):
     """Download isolated drum audio"""
-    if task_id not in task_registry:
+    task = await redis_client.hgetall(_task_key(task_id))
+
+    if not task:
         raise HTTPException(status_code=404, detail="Task not found")
-    
-    task = task_registry[task_id]
-    
+
     if task["status"] != "complete":
         raise HTTPException(status_code=400, detail="Processing not complete")
     
     drum_path = Path(task["drum_path"])
-    
-    if not drum_path.exists():
+
+    try:
+        stat_result = drum_path.stat()
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Drum audio not found")
-    
+
     return FileResponse(
         path=drum_path,
         media_type="audio/wav",
-        filename=f"{task['filename']}_drums.wav"
+        filename=f"{task['filename']}_drums.wav",
+        stat_result=stat_result
     )
 
+@app.get("/warmup")
+async def warmup():
+    """
+    Run a silent inference through the shared models so they stay
+    resident in this serving process. Hit by the deployment's warm cron.
+    """
+    await warm_models()
+    return {
+        "status": "warm",
+        "timestamp": datetime.now().isoformat()
+    }
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint for monitoring"""
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "active_tasks": len([t for t in task_registry.values() if t["status"] == "processing"])
+        "active_tasks": await redis_client.scard(RUNNING_TASKS_KEY)
     }
 
 @app.delete("/task/{task_id}")
-async def cancel_task(task_id: str):
+async def cancel_task(task_id: str = PathParam(pattern=TASK_ID_PATTERN)):
     """Cancel and cleanup task"""
-    if task_id in task_registry:
-        task = task_registry[task_id]
-        
+    task = await redis_client.hgetall(_task_key(task_id))
+
+    if task:
         # Cleanup files
         for key in ["upload_path", "midi_path", "drum_path"]:
             if key in task:
                 path = Path(task[key])
                 if path.exists():
                     path.unlink()
-        
+
         # Remove from registry
-        del task_registry[task_id]
-        
+        await redis_client.delete(_task_key(task_id))
+        await redis_client.zrem(TASKS_BY_CREATED_KEY, task_id)
+        await redis_client.srem(RUNNING_TASKS_KEY, task_id)
+        await redis_client.srem(FINISHED_TASKS_KEY, task_id)
+
         return {"status": "deleted", "task_id": task_id}
-    
+
     raise HTTPException(status_code=404, detail="Task not found")
@@ -7,22 +7,47 @@ and pre-downloaded Spleeter models to eliminate cold-start delays.
 import modal
 
 # Define container image with all dependencies
+# CUDA runtime base so TensorFlow can drive the T4 instead of falling back to CPU
 image = (
-    modal.Image.debian_slim(python_version="3.10")
+    modal.Image.from_registry(
+        "nvidia/cuda:11.2.2-cudnn8-runtime-ubuntu20.04",
+        add_python="3.10"
+    )
     .apt_install("ffmpeg")  # Required by Spleeter
     .pip_install(
         "fastapi[all]==0.104.1",
         "uvicorn==0.24.0",
         "spleeter==2.4.0",
         "basic-pitch==0.2.5",
-        "tensorflow==2.13.0",  # Pinned for Spleeter compatibility
+        "tensorflow==2.13.0",  # Pinned for Spleeter compatibility; bundles GPU support
         "pydantic==2.5.0",
-        "python-multipart==0.0.6"
+        "python-multipart==0.0.6",
+        "aiofiles==23.2.1",
+        "redis==5.0.1",
+        "janus==1.0.0",
+        "orjson==3.9.10",
+        "uvloop==0.19.0",
+        "httptools==0.6.1",
+        "onnxruntime-gpu==1.16.3",
+        "tensorrt==8.6.1",
+        "tf2onnx==1.15.1",
+        "onnxconverter-common==1.14.0"
+    )
+    # Pre-download both models at build time so warm containers never pay
+    # the download + graph-construction cost on a live request
+    .run_commands(
+        "python -c \"from spleeter.separator import Separator; Separator('spleeter:4stems')\"",
+        "python -c \"import tensorflow as tf; from basic_pitch import "
+        "ICASSP_2022_MODEL_PATH; tf.saved_model.load(str(ICASSP_2022_MODEL_PATH))\""
     )
-    # Pre-download Spleeter models to avoid first-run delays
+    # Export the 4-stems U-Nets to ONNX at build time so the runtime
+    # serves them via ONNX Runtime instead of the TF estimator path
+    .copy_local_file("onnx_separator.py", "/root/onnx_separator.py")
+    .copy_local_file("export_onnx.py", "/root/export_onnx.py")
     .run_commands(
-        "python -c \"from spleeter.separator import Separator; Separator('spleeter:4stems')\""
+        "python /root/export_onnx.py --output-dir /models/spleeter-4stems-onnx"
     )
+    .env({"SPLEETER_ONNX_DIR": "/models/spleeter-4stems-onnx"})
 )
 
 # Create Modal app
@@ -41,7 +66,10 @@ VOLUME_PATH = "/data"
     timeout=600,  # 10 minute timeout
     volumes={VOLUME_PATH: volume},
     allow_concurrent_inputs=10,  # Handle 10 simultaneous requests
-    keep_warm=1  # Keep one container warm during active hours
+    keep_warm=1,  # Keep one container warm during active hours
+    # Provides REDIS_URL - without it main.py falls back to localhost,
+    # where no Redis exists in the container
+    secrets=[modal.Secret.from_name("drumextract-redis")]
 )
 @modal.asgi_app()
 def fastapi_app():
@@ -52,18 +80,25 @@ def fastapi_app():
     from main import app
     return app
 
-# Keep-alive function to prevent cold starts during peak hours
+# Keep-alive function to prevent cold starts during peak hours. The ping
+# targets /warmup (not /health) so the serving container itself runs a
+# silent inference, keeping its separator pool, Basic-Pitch graph and
+# CUDA context resident - warming models inside this cron's own
+# container would do nothing for the process that handles requests.
 @app.function(
     schedule=modal.Cron("*/5 8-22 * * *")  # Every 5 min, 8am-10pm UTC
 )
-def keep_warm():
-    """Ping API to maintain warm container"""
+def warm_tf():
+    """Ping /warmup so the serving container's models stay resident"""
     import requests
     try:
-        response = requests.get("https://drumextract-api.modal.run/health")
-        print(f"Keep-warm ping: {response.status_code}")
+        response = requests.get(
+            "https://drumextract-api.modal.run/warmup",
+            timeout=120  # First hit after a cold start pays the model load
+        )
+        print(f"Warmup ping: {response.status_code}")
     except Exception as e:
-        print(f"Keep-warm failed: {e}")
+        print(f"Warmup failed: {e}")
 
 # Local development server
 @app.local_entrypoint()
@@ -76,5 +111,7 @@ def dev():
         fastapi_app,
         host="0.0.0.0",
         port=8000,
-        reload=True
+        reload=True,
+        loop="uvloop",
+        http="httptools"
     )
@@ -0,0 +1,229 @@
+"""
+ONNX Runtime backend for Spleeter 4-stems separation.
+
+Spleeter's TF estimator path pays heavy per-call overhead (DatasetV2
+generator setup, graph finalize) on top of inference itself. This module
+serves the exported U-Nets through ONNX Runtime with the TensorRT/CUDA
+execution providers instead: STFT and masking happen in numpy, only the
+spectrogram->mask networks run on the GPU, and sessions are built once.
+
+The per-stem graphs are produced offline by export_onnx.py.
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+STEMS = ("vocals", "drums", "bass", "other")
+
+# STFT parameters matching the spleeter:4stems training configuration
+SAMPLE_RATE = 44100
+FRAME_LENGTH = 4096
+FRAME_STEP = 1024
+N_FREQ_BINS = 1024      # the network only sees the first 1024 frequency bins
+SEGMENT_FRAMES = 512    # network input is 512-frame spectrogram segments
+EPSILON = 1e-10
+
+DEFAULT_PROVIDERS = [
+    "TensorrtExecutionProvider",
+    "CUDAExecutionProvider",
+    "CPUExecutionProvider",
+]
+
+# Marker file export_onnx.py drops in the model dir once the ONNX output
+# has been A/B-verified against the TF separator; the pipeline refuses
+# to prefer this backend without it
+VERIFIED_MARKER = "tf_verified"
+
+class OnnxSeparator:
+    """
+    Drop-in replacement for spleeter.Separator backed by ONNX Runtime.
+
+    Exposes the subset of the Separator API the pipeline uses
+    (separate / separate_to_file) so the two backends are interchangeable.
+    """
+
+    def __init__(self, model_dir, providers=None):
+        import onnxruntime
+
+        if providers is None:
+            providers = DEFAULT_PROVIDERS
+
+        model_dir = Path(model_dir)
+        self._sessions = {}
+        self._fused_session = None
+
+        # Prefer the fused drums-mask graph (one session.run, mask math
+        # on the GPU); fall back to the four per-stem graphs otherwise
+        try:
+            fused_path = self._pick_graph(model_dir, "drums_mask")
+        except FileNotFoundError:
+            for stem in STEMS:
+                model_path = self._pick_graph(model_dir, stem)
+                self._sessions[stem] = onnxruntime.InferenceSession(
+                    str(model_path),
+                    providers=providers
+                )
+        else:
+            self._fused_session = onnxruntime.InferenceSession(
+                str(fused_path),
+                providers=providers
+            )
+
+    @staticmethod
+    def _pick_graph(model_dir, stem):
+        """
+        Pick the fastest available graph variant for a stem.
+
+        export_onnx.py writes INT8 and FP16 variants alongside the FP32
+        graph; INT8 is only kept when it validated against the reference
+        clip, so precedence is simply int8 -> fp16 -> fp32.
+        """
+        for suffix in (".int8.onnx", ".fp16.onnx", ".onnx"):
+            candidate = model_dir / f"{stem}{suffix}"
+            if candidate.exists():
+                return candidate
+
+        raise FileNotFoundError(
+            f"Missing ONNX graph for stem '{stem}' in {model_dir}"
+        )
+
+    def separate(self, waveform):
+        """
+        Separate a (n_samples, 2) float32 waveform at 44.1 kHz.
+        Returns {stem_name: waveform} like Separator.separate; with the
+        fused graph only the 'drums' stem is produced - the others never
+        leave the GPU.
+        """
+        stft = self._stft(waveform)
+
+        # All four U-Nets share the same magnitude input
+        magnitude = np.abs(stft[:, :N_FREQ_BINS, :]).astype(np.float32)
+        segments = self._segment(magnitude)
+
+        if self._fused_session is not None:
+            mask_segments = self._run_session(self._fused_session, segments)
+            mask = self._unsegment(mask_segments, magnitude.shape[0])
+
+            full_mask = np.zeros(stft.shape, dtype=np.float32)
+            full_mask[:, :N_FREQ_BINS, :] = mask
+            return {"drums": self._istft(full_mask * stft, len(waveform))}
+
+        estimates = {}
+        for stem, session in self._sessions.items():
+            output = self._run_session(session, segments)
+            estimates[stem] = self._unsegment(output, magnitude.shape[0])
+
+        # Wiener-style ratio masks over the per-stem magnitude estimates
+        total = sum(np.square(estimate) for estimate in estimates.values()) + EPSILON
+
+        result = {}
+        for stem, estimate in estimates.items():
+            mask = np.square(estimate) / total
+            # Frequency bins above the network range pass through unmasked zero
+            full_mask = np.zeros(stft.shape, dtype=np.float32)
+            full_mask[:, :N_FREQ_BINS, :] = mask
+            result[stem] = self._istft(full_mask * stft, len(waveform))
+
+        return result
+
+    def separate_to_file(self, audio_descriptor, destination, synchronous=True):
+        """
+        Separate an audio file and write one WAV per stem, using the same
+        destination layout as Separator.separate_to_file
+        (<destination>/<filename_stem>/<stem>.wav).
+
+        synchronous is accepted for Separator API parity and ignored -
+        this backend is always synchronous.
+        """
+        import librosa
+        import soundfile as sf
+
+        audio_path = Path(audio_descriptor)
+
+        waveform, _ = librosa.load(
+            str(audio_path),
+            sr=SAMPLE_RATE,
+            mono=False
+        )
+        if waveform.ndim == 1:
+            waveform = np.stack([waveform, waveform])
+        waveform = waveform.T.astype(np.float32)
+
+        stem_folder = Path(destination) / audio_path.stem
+        stem_folder.mkdir(parents=True, exist_ok=True)
+
+        for stem, separated in self.separate(waveform).items():
+            sf.write(str(stem_folder / f"{stem}.wav"), separated, SAMPLE_RATE)
+
+    @staticmethod
+    def _run_session(session, segments):
+        """Run one graph over the segments, casting for FP16 variants."""
+        model_input = session.get_inputs()[0]
+        batch = segments
+        if model_input.type == "tensor(float16)":
+            batch = segments.astype(np.float16)
+        output = session.run(None, {model_input.name: batch})[0]
+        return output.astype(np.float32)
+
+    @staticmethod
+    def _window_scale():
+        """
+        scipy's stft divides the spectrum by the window sum; Spleeter's
+        U-Nets were trained on unscaled tf.signal.stft magnitudes, so
+        that factor (~2048 for hann/4096) must be undone on the way in
+        and reapplied before the inverse.
+        """
+        from scipy.signal import get_window
+
+        return get_window("hann", FRAME_LENGTH).sum()
+
+    @classmethod
+    def _stft(cls, waveform):
+        """(n_samples, channels) -> complex (frames, bins, channels)"""
+        from scipy.signal import stft
+
+        _, _, spec = stft(
+            waveform.T,
+            nperseg=FRAME_LENGTH,
+            noverlap=FRAME_LENGTH - FRAME_STEP,
+            window="hann",
+            padded=True
+        )
+        return np.transpose(spec, (2, 1, 0)) * cls._window_scale()
+
+    @classmethod
+    def _istft(cls, spec, n_samples):
+        """complex (frames, bins, channels) -> (n_samples, channels)"""
+        from scipy.signal import istft
+
+        _, reconstructed = istft(
+            np.transpose(spec / cls._window_scale(), (2, 1, 0)),
+            nperseg=FRAME_LENGTH,
+            noverlap=FRAME_LENGTH - FRAME_STEP,
+            window="hann"
+        )
+        return reconstructed.T[:n_samples].astype(np.float32)
+
+    @staticmethod
+    def _segment(magnitude):
+        """
+        Pad the (frames, bins, channels) magnitude to a whole number of
+        segments and reshape to the network's (batch, T, F, channels) input.
+        """
+        n_frames = magnitude.shape[0]
+        n_segments = -(-n_frames // SEGMENT_FRAMES)  # ceil division
+        padding = n_segments * SEGMENT_FRAMES - n_frames
+
+        if padding:
+            magnitude = np.pad(magnitude, ((0, padding), (0, 0), (0, 0)))
+
+        return magnitude.reshape(
+            n_segments, SEGMENT_FRAMES, N_FREQ_BINS, magnitude.shape[-1]
+        )
+
+    @staticmethod
+    def _unsegment(segments, n_frames):
+        """Inverse of _segment: flatten batches and trim the padding."""
+        flat = segments.reshape(-1, *segments.shape[2:])
+        return flat[:n_frames]
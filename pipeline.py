@@ -5,12 +5,371 @@ with async progress reporting.
 """
 
 import asyncio
+import concurrent.futures
+import mmap
 import subprocess
 import os
+from collections import deque
 from pathlib import Path
 from typing import AsyncGenerator, Dict
 from enum import Enum
 
+import janus
+
+# Number of separator slots kept warm. Two slots pipeline well on a T4:
+# while one job's U-Net occupies the GPU, the other's decode/STFT keeps
+# the CPU busy feeding it (TF 2.13 releases the GIL around session.run).
+# More than two just thrashes the card.
+SEPARATOR_POOL_SIZE = int(os.environ.get("SEPARATOR_POOL_SIZE", "2"))
+
+# All TF inference funnels through this small executor, sized to the
+# separator pool. The default thread pool would let up to 32 jobs thrash
+# the one GPU under concurrent requests.
+_TF_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=SEPARATOR_POOL_SIZE, thread_name_prefix="tf"
+)
+
+# Separator instances live in _SEPARATOR_POOL (below) and the Basic-Pitch
+# model is a singleton - both built once at container warmup and reused.
+# Loading the Spleeter graph costs ~6s; re-creating it per call also forces
+# TensorFlow to re-initialize the GPU context every time.
+_BASIC_PITCH_MODEL = None
+
+# Directory holding the per-stem ONNX graphs produced by export_onnx.py.
+# When present, separation runs through ONNX Runtime (TensorRT/CUDA)
+# instead of the TF estimator path.
+ONNX_MODEL_DIR = os.environ.get("SPLEETER_ONNX_DIR", "/models/spleeter-4stems-onnx")
+
+def _configure_tf_gpu():
+    """
+    Pin TF to the GPU (when present) and enable memory growth so the
+    allocator doesn't grab the whole card up front - both models share it.
+    """
+    import tensorflow as tf
+
+    gpus = tf.config.list_physical_devices('GPU')
+    if gpus:
+        tf.config.set_visible_devices(gpus[0], 'GPU')
+        tf.config.experimental.set_memory_growth(gpus[0], True)
+
+def _build_separator():
+    """
+    Build one GPU-bound separator instance for the pool.
+
+    Prefers the ONNX Runtime backend (no per-call estimator overhead,
+    FP16 tensor-core inference via TensorRT) and falls back to the TF
+    Spleeter Separator when the exported graphs aren't available.
+    """
+    if os.path.isdir(ONNX_MODEL_DIR):
+        from onnx_separator import OnnxSeparator, VERIFIED_MARKER
+
+        # Only trust the exported graphs if the build-time A/B check
+        # against the TF separator passed (export_onnx.py drops the marker)
+        if os.path.isfile(os.path.join(ONNX_MODEL_DIR, VERIFIED_MARKER)):
+            return OnnxSeparator(ONNX_MODEL_DIR)
+
+        # export_onnx.py fails the build when verification fails, so a
+        # missing marker means a stale or hand-rolled model dir - shout,
+        # because the TF fallback silently costs the ONNX speedup
+        print(
+            f"WARNING: {ONNX_MODEL_DIR} exists but has no "
+            f"'{VERIFIED_MARKER}' marker - ONNX graphs unverified, "
+            f"falling back to the TF Separator"
+        )
+
+    from spleeter.separator import Separator
+
+    _configure_tf_gpu()
+    # multiprocess=False: the instance lives on a dedicated executor
+    # thread, so spleeter's own process pool would only add overhead
+    return Separator('spleeter:4stems', multiprocess=False)
+
+class _SeparatorPool:
+    """
+    Checkout pool of pre-initialized separators.
+
+    A semaphore caps concurrent checkouts at the pool size; instances
+    are built lazily on the TF executor thread the first time each slot
+    is used and returned to the idle deque afterwards, so independent
+    jobs can overlap one job's CPU-side decode/STFT with another's
+    GPU-side U-Net.
+    """
+
+    def __init__(self, size: int):
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle = deque()
+
+    async def run(self, func, *args):
+        """
+        Run func(separator, *args) on the TF executor with a checked-out
+        separator and return its result.
+        """
+        loop = asyncio.get_event_loop()
+
+        async with self._semaphore:
+            separator = self._idle.popleft() if self._idle else None
+            separator, result = await loop.run_in_executor(
+                _TF_EXECUTOR, self._run_with, separator, func, args
+            )
+            self._idle.append(separator)
+
+            return result
+
+    @staticmethod
+    def _run_with(separator, func, args):
+        if separator is None:
+            separator = _build_separator()
+        return separator, func(separator, *args)
+
+_SEPARATOR_POOL = _SeparatorPool(SEPARATOR_POOL_SIZE)
+
+# Basic-Pitch windows audio into fixed ~2s frames of this many samples
+BASIC_PITCH_WINDOW_SAMPLES = 43844
+
+# Windows per compiled call. XLA compiles one executable per concrete
+# input shape, and run_inference hands us the whole track as one batch
+# whose window count varies per upload - so the batch dimension must be
+# pinned too, or every track pays a fresh multi-second compile. Eight
+# windows (~16s of audio) keeps the T4 busy without padding waste.
+_XLA_BATCH_WINDOWS = 8
+
+class _CompiledBasicPitch:
+    """
+    Basic-Pitch saved-model behind a fixed-shape, jit-compiled call.
+
+    Wrapping the model in a tf.function with a fully pinned input
+    signature - window length AND batch size - means XLA compiles the
+    conv stack exactly once; the wrapper chunks the incoming windows to
+    that batch size, zero-padding the last chunk. jit_compile buys
+    ~20-30% on top of avoiding the retrace.
+    """
+
+    def __init__(self, model):
+        import tensorflow as tf
+
+        self._tf = tf
+        self._compiled = tf.function(
+            lambda frames: model(frames),
+            input_signature=[
+                tf.TensorSpec(
+                    [_XLA_BATCH_WINDOWS, BASIC_PITCH_WINDOW_SAMPLES, 1],
+                    tf.float32
+                )
+            ],
+            jit_compile=True
+        )
+
+    def __call__(self, frames):
+        tf = self._tf
+
+        frames = tf.convert_to_tensor(frames, dtype=tf.float32)
+        n_windows = int(frames.shape[0])
+
+        outputs: Dict[str, list] = {}
+        for start in range(0, n_windows, _XLA_BATCH_WINDOWS):
+            chunk = frames[start:start + _XLA_BATCH_WINDOWS]
+            n_real = int(chunk.shape[0])
+
+            if n_real < _XLA_BATCH_WINDOWS:
+                chunk = tf.pad(
+                    chunk,
+                    [[0, _XLA_BATCH_WINDOWS - n_real], [0, 0], [0, 0]]
+                )
+
+            for key, value in self._compiled(chunk).items():
+                outputs.setdefault(key, []).append(value[:n_real])
+
+        return {
+            key: tf.concat(values, axis=0)
+            for key, values in outputs.items()
+        }
+
+    # basic_pitch's inference helpers call either convention
+    predict = __call__
+
+def _get_basic_pitch_model():
+    """
+    Lazily load the Basic-Pitch saved-model once instead of per call.
+    """
+    global _BASIC_PITCH_MODEL
+    if _BASIC_PITCH_MODEL is None:
+        import tensorflow as tf
+        from basic_pitch import ICASSP_2022_MODEL_PATH
+
+        _configure_tf_gpu()
+        # basic-pitch 0.2.5 has no Model wrapper; predict() accepts any
+        # loaded saved-model object and calls it on the audio windows
+        _BASIC_PITCH_MODEL = _CompiledBasicPitch(
+            tf.saved_model.load(str(ICASSP_2022_MODEL_PATH))
+        )
+
+    return _BASIC_PITCH_MODEL
+
+# All audio is processed at Spleeter's native rate
+SAMPLE_RATE = 44100
+
+# Basic-Pitch operates at 22.05 kHz mono; resampling the in-memory drum
+# stem once avoids a second full ffmpeg decode + resample of the WAV
+BASIC_PITCH_SAMPLE_RATE = 22050
+
+# Sub-stage progress pushed from the TF thread buffers up to this many
+# updates before new ones are dropped (never blocking inference)
+PROGRESS_QUEUE_MAXSIZE = 16
+
+def _progress_reporter(sync_q, stage):
+    """
+    Build a thread-safe callback the TF thread can use to push sub-stage
+    progress. Updates are dropped when the queue is full - inference
+    never waits on a slow consumer.
+    """
+    def report(percent: float, message: str):
+        try:
+            sync_q.put_nowait({
+                "stage": stage,
+                "percent": percent,
+                "message": message
+            })
+        except janus.SyncQueueFull:
+            pass
+
+    return report
+
+# Cap on how many queued separations one executor pass will take. Requests
+# that pile up while a batch is on the GPU get dispatched together in the
+# next pass; nobody waits for stragglers that haven't arrived yet.
+_BATCH_MAX_SIZE = 8
+
+class _SeparationBatcher:
+    """
+    Coalesces concurrent separation requests into batched Separator calls.
+
+    Callers submit an audio path and await a future that resolves with the
+    separated drum waveform (ndarray at SAMPLE_RATE). Consumer tasks drain
+    the queue and dispatch immediately with whatever is pending (up to
+    _BATCH_MAX_SIZE items) in a single thread-pool hop - work that arrives
+    while a batch occupies the GPU coalesces into the next one, and a lone
+    request pays no artificial wait.
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._consumer_tasks = []
+
+    async def submit(self, audio_path: Path, report=None):
+        loop = asyncio.get_event_loop()
+
+        # Start the consumers lazily so the queue binds to the running
+        # loop; one consumer per separator slot lets batches overlap
+        if not self._consumer_tasks:
+            self._consumer_tasks = [
+                loop.create_task(self._consume())
+                for _ in range(SEPARATOR_POOL_SIZE)
+            ]
+
+        future = loop.create_future()
+        await self._queue.put((audio_path, report, future))
+        return await future
+
+    async def _consume(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            batch = [await self._queue.get()]
+
+            # Take whatever else is already queued, but don't wait for
+            # stragglers - the batch runs sequentially on the executor,
+            # so a collection window would be pure added latency
+            while len(batch) < _BATCH_MAX_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            items = [(audio_path, report) for audio_path, report, _ in batch]
+
+            try:
+                results = await _SEPARATOR_POOL.run(self._separate_batch, items)
+            except Exception as exc:
+                results = [exc] * len(batch)
+
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    @staticmethod
+    def _separate_batch(separator, items):
+        """
+        Run a batch of separations on the executor thread with a
+        pool-checked-out separator.
+
+        Uses separate() on in-memory waveforms and keeps only the drum
+        stem - separate_to_file would write all four stems to disk (often
+        >100 MB) just for three of them to be deleted. The batch runs
+        sequentially inside a single executor hop so the model stays hot
+        between files and per-file failures don't poison the batch.
+        """
+        from spleeter.audio.adapter import AudioAdapter
+
+        adapter = AudioAdapter.default()
+        results = []
+
+        for audio_path, report in items:
+            try:
+                if report:
+                    report(10, "Decoding audio...")
+                waveform, _ = adapter.load(
+                    str(audio_path), sample_rate=SAMPLE_RATE
+                )
+
+                if report:
+                    report(40, "Running stem separation...")
+                prediction = separator.separate(waveform)
+
+                if report:
+                    report(90, "Drum stem extracted")
+                results.append(prediction['drums'])
+            except Exception as exc:
+                results.append(exc)
+
+        return results
+
+_SEPARATION_BATCHER = _SeparationBatcher()
+
+async def warm_models():
+    """
+    Run a one-second silent inference through the shared models.
+
+    Goes through the separator pool and the Basic-Pitch singleton - the
+    same instances that serve requests - so this process's CUDA context,
+    separator graphs and compiled tf.function stay resident and the next
+    real request skips the ~6s reload and retrace. Exposed via the
+    /warmup endpoint, which the deployment's warm cron hits.
+    """
+    await _SEPARATOR_POOL.run(_warm_pass)
+
+def _warm_pass(separator):
+    """Silent inference through one pool separator plus Basic-Pitch."""
+    import tempfile
+
+    import numpy as np
+    import soundfile as sf
+
+    from basic_pitch.inference import predict
+
+    separator.separate(np.zeros((SAMPLE_RATE, 2), dtype=np.float32))
+
+    with tempfile.NamedTemporaryFile(suffix=".wav") as tmp:
+        sf.write(
+            tmp.name,
+            np.zeros(BASIC_PITCH_SAMPLE_RATE, dtype=np.float32),
+            BASIC_PITCH_SAMPLE_RATE
+        )
+        predict(tmp.name, _get_basic_pitch_model())
+
 class ProcessingStage(str, Enum):
     SEPARATION = "separation"
     MIDI_CONVERSION = "midi_conversion"
@@ -40,37 +399,61 @@ class DrumPipeline:
         }
         """
         audio_path = Path(audio_path)
-        
-        # Stage 1: Stem Separation
-        yield {
-            "stage": ProcessingStage.SEPARATION,
-            "percent": 0,
-            "message": "Initializing Spleeter engine..."
-        }
-        
-        drum_path = await self._separate_drums(task_id, audio_path)
-        
-        yield {
-            "stage": ProcessingStage.SEPARATION,
-            "percent": 100,
-            "message": "Drum stem isolated successfully"
-        }
-        
-        # Stage 2: MIDI Conversion
-        yield {
-            "stage": ProcessingStage.MIDI_CONVERSION,
-            "percent": 0,
-            "message": "Analyzing drum transients..."
-        }
-        
-        midi_path = await self._convert_to_midi(task_id, drum_path)
-        
-        yield {
-            "stage": ProcessingStage.MIDI_CONVERSION,
-            "percent": 100,
-            "message": "MIDI extraction complete"
-        }
-        
+
+        # Sub-stage progress flows through here from the TF thread, so
+        # clients see movement inside each stage instead of 0 -> 100 jumps
+        progress_queue: janus.Queue = janus.Queue(maxsize=PROGRESS_QUEUE_MAXSIZE)
+
+        try:
+            # Stage 1: Stem Separation
+            yield {
+                "stage": ProcessingStage.SEPARATION,
+                "percent": 0,
+                "message": "Initializing Spleeter engine..."
+            }
+
+            report = _progress_reporter(
+                progress_queue.sync_q, ProcessingStage.SEPARATION
+            )
+            work = asyncio.create_task(
+                self._separate_drums(task_id, audio_path, report)
+            )
+            async for update in self._stream_progress(work, progress_queue):
+                yield update
+            drum_path, drums = work.result()
+
+            yield {
+                "stage": ProcessingStage.SEPARATION,
+                "percent": 100,
+                "message": "Drum stem isolated successfully"
+            }
+
+            # Stage 2: MIDI Conversion
+            yield {
+                "stage": ProcessingStage.MIDI_CONVERSION,
+                "percent": 0,
+                "message": "Analyzing drum transients..."
+            }
+
+            report = _progress_reporter(
+                progress_queue.sync_q, ProcessingStage.MIDI_CONVERSION
+            )
+            work = asyncio.create_task(
+                self._convert_to_midi(task_id, drums, report)
+            )
+            async for update in self._stream_progress(work, progress_queue):
+                yield update
+            midi_path = work.result()
+
+            yield {
+                "stage": ProcessingStage.MIDI_CONVERSION,
+                "percent": 100,
+                "message": "MIDI extraction complete"
+            }
+        finally:
+            progress_queue.close()
+            await progress_queue.wait_closed()
+
         # Stage 3: Validation
         yield {
             "stage": ProcessingStage.VALIDATION,
@@ -93,94 +476,119 @@ class DrumPipeline:
             "message": "Processing complete - ready for download"
         }
     
-    async def _separate_drums(self, task_id: str, audio_path: Path) -> Path:
+    @staticmethod
+    async def _stream_progress(work: asyncio.Task, progress_queue: janus.Queue):
+        """
+        Yield sub-stage progress pushed from the TF thread until the
+        work task completes. Errors surface via work.result() afterwards.
+        """
+        while True:
+            getter = asyncio.ensure_future(progress_queue.async_q.get())
+            done, _ = await asyncio.wait(
+                {getter, work}, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            if getter in done:
+                yield getter.result()
+                continue
+
+            getter.cancel()
+
+            # Flush updates that raced with completion
+            while not progress_queue.async_q.empty():
+                yield progress_queue.async_q.get_nowait()
+
+            break
+
+    async def _separate_drums(self, task_id: str, audio_path: Path,
+                              report=None):
         """
         Run Spleeter to isolate drum stem.
-        Returns path to drums.wav
+        Returns (path to drums.wav, drum waveform at SAMPLE_RATE) so the
+        MIDI stage can reuse the decoded PCM instead of re-reading the WAV.
         """
-        from spleeter.separator import Separator
-        from spleeter.audio.adapter import AudioAdapter
-        
-        # Create separator instance
-        separator = Separator('spleeter:4stems')
-        
-        # Output goes to temporary directory
-        temp_output = self.output_dir / f"{task_id}_stems"
-        temp_output.mkdir(exist_ok=True)
-        
-        # Run separation in thread pool (Spleeter is CPU-bound)
+        import soundfile as sf
+
+        # Submit to the batcher - concurrent requests share one model
+        # pass, and only the drum waveform comes back (in memory)
+        drums = await _SEPARATION_BATCHER.submit(audio_path, report)
+
+        # Single write: the other three stems never touch disk
+        drum_final = self.output_dir / f"{task_id}_drums.wav"
         loop = asyncio.get_event_loop()
         await loop.run_in_executor(
-            None,
-            separator.separate_to_file,
-            str(audio_path),
-            str(temp_output)
+            None, sf.write, str(drum_final), drums, SAMPLE_RATE
         )
-        
-        # Spleeter creates subfolder with audio filename
-        stem_folder = temp_output / audio_path.stem
-        drum_source = stem_folder / "drums.wav"
-        
-        if not drum_source.exists():
-            raise FileNotFoundError(f"Spleeter did not generate drums.wav at {drum_source}")
-        
-        # Move to final location
-        drum_final = self.output_dir / f"{task_id}_drums.wav"
-        drum_source.rename(drum_final)
-        
-        # Cleanup temporary directory
-        import shutil
-        shutil.rmtree(temp_output)
-        
-        return drum_final
+
+        return drum_final, drums
     
-    async def _convert_to_midi(self, task_id: str, drum_path: Path) -> Path:
+    async def _convert_to_midi(self, task_id: str, drums,
+                               report=None) -> Path:
         """
-        Run Basic-Pitch to convert drum audio to MIDI.
+        Run Basic-Pitch to convert the separated drum waveform to MIDI.
         Returns path to .mid file
         """
-        from basic_pitch.inference import predict_and_save
-        from basic_pitch import ICASSP_2022_MODEL_PATH
-        
+        import librosa
+        import soundfile as sf
+
         # Output MIDI path
         midi_output = self.output_dir / f"{task_id}_drums.mid"
-        
-        # Run Basic-Pitch in thread pool
+
+        # Downmix and resample the in-memory stem once with soxr; the
+        # intermediate WAV is already at Basic-Pitch's native rate, so
+        # its internal load is a plain sr-matched read instead of a
+        # second ffmpeg decode + resample of the 44.1 kHz stereo file
+        def _prepare():
+            mono = drums.mean(axis=1) if drums.ndim == 2 else drums
+            return librosa.resample(
+                mono,
+                orig_sr=SAMPLE_RATE,
+                target_sr=BASIC_PITCH_SAMPLE_RATE,
+                res_type='soxr_hq'
+            )
+
         loop = asyncio.get_event_loop()
+        resampled = await loop.run_in_executor(None, _prepare)
+
+        temp_wav = self.output_dir / f"{task_id}_drums_22k.wav"
         await loop.run_in_executor(
-            None,
-            self._run_basic_pitch,
-            str(drum_path),
-            str(self.output_dir),
-            task_id
+            None, sf.write, str(temp_wav), resampled, BASIC_PITCH_SAMPLE_RATE
         )
-        
-        # Basic-Pitch creates file with specific naming
-        generated_midi = self.output_dir / f"{drum_path.stem}_basic_pitch.mid"
-        
-        if not generated_midi.exists():
-            raise FileNotFoundError(f"Basic-Pitch did not generate MIDI at {generated_midi}")
-        
-        # Rename to expected output
-        generated_midi.rename(midi_output)
-        
+
+        # Run Basic-Pitch on the dedicated TF thread
+        try:
+            midi_data = await loop.run_in_executor(
+                _TF_EXECUTOR,
+                self._run_basic_pitch,
+                str(temp_wav),
+                report
+            )
+        finally:
+            temp_wav.unlink(missing_ok=True)
+
+        # Serialize straight to the target path - predict_and_save's
+        # choose-a-filename-then-rename dance (and its extra directory
+        # scan) is gone
+        await loop.run_in_executor(None, midi_data.write, str(midi_output))
+
         return midi_output
-    
-    def _run_basic_pitch(self, audio_path: str, output_dir: str, task_id: str):
+
+    def _run_basic_pitch(self, audio_path: str, report=None):
         """
-        Wrapper to run Basic-Pitch with proper parameters.
-        Must run in thread pool due to TensorFlow blocking.
+        Run Basic-Pitch inference in-process and return the PrettyMIDI
+        result. Must run on the TF thread due to TensorFlow blocking.
         """
-        from basic_pitch.inference import predict_and_save
-        
-        predict_and_save(
-            audio_path_list=[audio_path],
-            output_directory=output_dir,
-            save_midi=True,
-            sonify_midi=False,
-            save_model_outputs=False,
-            save_notes=False
-        )
+        from basic_pitch.inference import predict
+
+        if report:
+            report(20, "Running note detection...")
+
+        _, midi_data, _ = predict(audio_path, _get_basic_pitch_model())
+
+        if report:
+            report(85, "Note events decoded")
+
+        return midi_data
     
     def _validate_outputs(self, drum_path: Path, midi_path: Path):
         """
@@ -193,15 +601,24 @@ class DrumPipeline:
         if drum_path.stat().st_size < 1000:  # Less than 1KB is suspicious
             raise ValueError(f"Drum audio file too small: {drum_path}")
         
-        # Check MIDI exists and has content
-        if not midi_path.exists():
+        # Check MIDI exists and has valid content. A single mmap gives
+        # size and header together (no separate stat + read) and leaves
+        # the pages warm for the download response that follows.
+        try:
+            with open(midi_path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
             raise FileNotFoundError(f"MIDI file not found: {midi_path}")
-        
-        if midi_path.stat().st_size < 100:  # MIDI header alone is ~14 bytes
+        except ValueError:
+            # mmap rejects empty files
             raise ValueError(f"MIDI file too small: {midi_path}")
-        
-        # Validate MIDI file header (MThd magic number)
-        with open(midi_path, 'rb') as f:
-            header = f.read(4)
-            if header != b'MThd':
+
+        try:
+            if len(mapped) < 100:  # MIDI header alone is ~14 bytes
+                raise ValueError(f"MIDI file too small: {midi_path}")
+
+            # Validate MIDI file header (MThd magic number)
+            if bytes(mapped[:4]) != b'MThd':
                 raise ValueError(f"Invalid MIDI file format: {midi_path}")
+        finally:
+            mapped.close()